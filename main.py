@@ -1,6 +1,22 @@
 import pygame
 from pygame.math import Vector2
-import tmx
+import numpy as np
+import xml.etree.ElementTree as ElementTree
+import argparse
+import base64
+import contextlib
+import fnmatch
+import gc
+import gzip
+import inspect
+import queue
+import re
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
 import os
 import math
 
@@ -36,18 +52,59 @@ class Bullet(GameItem):
         self.end_position = unit.weapon_target
 
 
+class TileGrid:
+    """
+    Tile layer stored as a (height, width) array of local tile ids, -1 for empty cells
+    """
+
+    def __init__(self, width, height, columns, tile=None):
+        self.columns = columns
+        self.lids = np.full((height, width), -1, dtype=np.int32)
+        if tile is not None:
+            self.lids[:] = int(tile.x) + int(tile.y) * columns
+
+    @property
+    def width(self):
+        return self.lids.shape[1]
+
+    @property
+    def height(self):
+        return self.lids.shape[0]
+
+    def set_tiles(self, lids, columns):
+        """
+        Replace all tiles with a (height, width) array of local tile ids
+        """
+        self.columns = columns
+        self.lids = np.asarray(lids, dtype=np.int32)
+
+    def tile(self, x, y):
+        """
+        Returns the tile coordinates in the tileset at cell (x, y), otherwise None.
+        """
+        lid = int(self.lids[y, x])
+        if lid < 0:
+            return None
+        return Vector2(lid % self.columns, lid // self.columns)
+
+
 class GameState:
     def __init__(self):
         self.epoch = 0
         self.world_size = Vector2(16, 10)
-        self.ground = [[Vector2(5, 1)] * 16] * 10
-        self.walls = [[None] * 16] * 10
+        self.ground = TileGrid(16, 10, 16, Vector2(5, 1))
+        self.walls = TileGrid(16, 10, 16)
+        self.blocking = None
+        self.update_blocking()
         self.units = [Unit(self, Vector2(8, 9), Vector2(1, 0))]
         self.bullets = []
         self.bullet_speed = 0.1
         self.bullet_range = 4
         self.bullet_delay = 5
+        self.view_radius = 6
         self.observers = []
+        self.visibility = Visibility(self)
+        self.add_observer(self.visibility)
 
     @property
     def world_width(self):
@@ -63,6 +120,26 @@ class GameState:
         """
         return 0 <= position.x < self.world_width and 0 <= position.y < self.world_height
 
+    def set_walls(self, lids, columns):
+        """
+        Replace the walls, rebuild the blocking cells, and notify the observers
+        """
+        self.walls.set_tiles(lids, columns)
+        self.update_blocking()
+        self.notify_walls_changed()
+
+    def update_blocking(self):
+        """
+        Rebuild the packed bitmask of blocking cells (one bit per cell, 8 cells per byte) from the walls
+        """
+        self.blocking = np.packbits(self.walls.lids >= 0, axis=1)
+
+    def is_blocked(self, x, y):
+        """
+        Returns true if cell (x, y) can't be crossed
+        """
+        return bool(self.blocking[y, x >> 3] & (0x80 >> (x & 7)))
+
     def find_unit(self, position):
         """
         Returns the index of the first unit at position, otherwise None.
@@ -88,11 +165,364 @@ class GameState:
         for observer in self.observers:
             observer.unit_destroyed(unit)
 
+    def notify_walls_changed(self):
+        for observer in self.observers:
+            observer.walls_changed()
+
 
 class GameStateObserver:
     def unit_destroyed(self, unit):
         pass
 
+    def walls_changed(self):
+        pass
+
+
+###############################################################################
+#                                Visibility                                   #
+###############################################################################
+
+
+class FieldOfView:
+    """
+    Cells visible from a source cell, stored in a window around it
+    """
+
+    def __init__(self, left, top, mask):
+        self.left = left
+        self.top = top
+        self.mask = mask
+        self.spans = None
+
+    def is_visible(self, x, y):
+        x -= self.left
+        y -= self.top
+        return 0 <= y < len(self.mask) and 0 <= x < len(self.mask[y]) and self.mask[y][x]
+
+    def row_spans(self):
+        """
+        Returns the visible cells as a list of (x, y, length) horizontal runs
+        """
+        if self.spans is None:
+            self.spans = []
+            for y, row in enumerate(self.mask):
+                start = None
+                for x, visible in enumerate(row + [False]):
+                    if visible and start is None:
+                        start = x
+                    elif not visible and start is not None:
+                        self.spans.append((self.left + start, self.top + y, x - start))
+                        start = None
+        return self.spans
+
+
+class Visibility(GameStateObserver):
+    """
+    Field of view computed with symmetric shadowcasting on the blocking cells, cached per source cell
+    until the walls change
+
+    Between two non blocking cells, visibility is symmetric: a unit sees the player's unit if and only if
+    the player's unit sees it (also with fog of war). Walls are visible if any part of them is lit.
+    """
+
+    # Transforms from (column, depth) in a quadrant to (x, y) offsets: (x column, x depth, y column, y depth)
+    quadrants = [(1, 0, 0, -1), (0, 1, 1, 0), (1, 0, 0, 1), (0, -1, 1, 0)]
+
+    def __init__(self, state):
+        self.state = state
+        self.cache = {}
+
+    def walls_changed(self):
+        self.cache.clear()
+
+    def field_of_view(self, position):
+        """
+        Returns the (cached) field of view from the cell at position
+        """
+        x = int(position.x)
+        y = int(position.y)
+        fov = self.cache.get((x, y))
+        if fov is None:
+            fov = self.compute_field_of_view(x, y, self.state.view_radius)
+            self.cache[(x, y)] = fov
+        return fov
+
+    def can_see(self, a, b):
+        """
+        Returns true if the cell at position b is visible from the cell at position a
+        """
+        return self.field_of_view(a).is_visible(int(b.x), int(b.y))
+
+    def compute_field_of_view(self, x, y, radius):
+        # Window around the source cell, cells outside the world block the view
+        left = max(0, x - radius)
+        top = max(0, y - radius)
+        right = min(self.state.world_width, x + radius + 1)
+        bottom = min(self.state.world_height, y + radius + 1)
+        blocking = np.unpackbits(self.state.blocking[top:bottom], axis=1, count=self.state.world_width)
+        opaque = blocking[:, left:right].astype(bool).tolist()
+        mask = [[False] * (right - left) for _ in range(bottom - top)]
+        if 0 <= y - top < len(mask) and 0 <= x - left < len(mask[0]):
+            mask[y - top][x - left] = True
+            for quadrant in self.quadrants:
+                self.scan(opaque, mask, x - left, y - top, 1, (-1, 1), (1, 1), radius, quadrant)
+        return FieldOfView(left, top, mask)
+
+    def scan(self, opaque, mask, cx, cy, depth, start, end, radius, quadrant):
+        """
+        Scan the row at depth in a quadrant, between the start and end slopes given as (numerator,
+        denominator) pairs; integer arithmetic keeps the slope comparisons exact
+        """
+        if depth > radius:
+            return
+        xc, xd, yc, yd = quadrant
+        start_num, start_den = start
+        end_num, end_den = end
+        # Columns of the cells whose centers are between the slopes (ties rounded towards the inside)
+        min_column = (2 * depth * start_num + start_den) // (2 * start_den)
+        max_column = -((end_den - 2 * depth * end_num) // (2 * end_den))
+        previous_wall = None
+        for column in range(min_column, max_column + 1):
+            cell_x = cx + column * xc + depth * xd
+            cell_y = cy + column * yc + depth * yd
+            inside = 0 <= cell_y < len(opaque) and 0 <= cell_x < len(opaque[0])
+            wall = not inside or opaque[cell_y][cell_x]
+            # Floor cells are visible if their center is between the slopes, so that visibility is symmetric
+            centered = column * start_den >= depth * start_num and column * end_den <= depth * end_num
+            if inside and column * column + depth * depth <= radius * radius and (wall or centered):
+                mask[cell_y][cell_x] = True
+            if previous_wall and not wall:
+                start_num, start_den = 2 * column - 1, 2 * depth
+            elif previous_wall is False and wall:
+                self.scan(opaque, mask, cx, cy, depth + 1, (start_num, start_den), (2 * column - 1, 2 * depth),
+                          radius, quadrant)
+            previous_wall = wall
+        if previous_wall is False:
+            self.scan(opaque, mask, cx, cy, depth + 1, (start_num, start_den), end, radius, quadrant)
+
+
+###############################################################################
+#                               Level Files                                   #
+###############################################################################
+
+
+class TileMapImage:
+    def __init__(self, source, data):
+        self.source = source
+        self.data = data
+
+
+class TileMapTileset:
+    def __init__(self, firstgid, tilewidth, tileheight, tilecount, columns, image):
+        self.firstgid = firstgid
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.tilecount = tilecount
+        self.columns = columns
+        self.image = image
+
+
+class TileMapLayer:
+    def __init__(self, name, width, height, gids):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.gids = gids
+
+
+class TileMap:
+    """
+    Minimal TMX reader: layer data is decoded in one pass into an array of gids
+    (csv, xml, or base64 with optional zlib/gzip compression)
+    """
+
+    # Tiled stores flip flags in the three highest bits of each gid
+    flip_flags_mask = 0xE0000000
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.orientation = "orthogonal"
+        self.width = 0
+        self.height = 0
+        self.tilesets = []
+        self.layers = []
+
+    @classmethod
+    def load(cls, file_name):
+        tile_map = cls(file_name)
+        root = ElementTree.parse(file_name).getroot()
+        if root.attrib.get("infinite", "0") != "0":
+            raise RuntimeError("Error in {}: infinite maps are not supported".format(file_name))
+        tile_map.orientation = root.attrib.get("orientation", tile_map.orientation)
+        tile_map.width = int(root.attrib.get("width", 0))
+        tile_map.height = int(root.attrib.get("height", 0))
+        for child in root:
+            if child.tag == "tileset":
+                tile_map.tilesets.append(tile_map.read_tileset(child, os.path.dirname(file_name)))
+            elif child.tag == "layer":
+                tile_map.layers.append(tile_map.read_layer(child))
+            elif child.tag in ("objectgroup", "imagelayer", "group"):
+                # Kept as raw elements, so the level checks can reject them
+                tile_map.layers.append(child)
+        return tile_map
+
+    @classmethod
+    def load_level(cls, file_name):
+        """
+        Load a level file and check its main properties
+        """
+        if not os.path.exists(file_name):
+            raise RuntimeError("No file {}".format(file_name))
+        tile_map = cls.load(file_name)
+        if tile_map.orientation != "orthogonal":
+            raise RuntimeError("Error in {}: invalid orientation".format(file_name))
+        if len(tile_map.layers) != 5:
+            raise RuntimeError("Error in {}: 5 layers are expected".format(file_name))
+        return tile_map
+
+    def decode_layer(self, layer):
+        """
+        Decode layer and check layer properties
+
+        Returns the corresponding tileset and the local tile ids (-1 for empty cells) as a (height, width) array
+        """
+        if not isinstance(layer, TileMapLayer):
+            raise RuntimeError("Error in {}: invalid layer type".format(self.file_name))
+        if layer.gids.size != self.width * self.height:
+            raise RuntimeError("Error in {}: invalid tiles count".format(self.file_name))
+
+        # Guess which tileset is used by this layer
+        non_empty = np.flatnonzero(layer.gids)
+        if non_empty.size == 0:
+            if len(self.tilesets) == 0:
+                raise RuntimeError("Error in {}: no tilesets".format(self.file_name))
+            tileset = self.tilesets[0]
+        else:
+            gid = int(layer.gids[non_empty[0]])
+            tileset = None
+            for t in self.tilesets:
+                if t.firstgid <= gid < t.firstgid + t.tilecount:
+                    tileset = t
+                    break
+            if tileset is None:
+                raise RuntimeError("Error in {}: no corresponding tileset".format(self.file_name))
+
+        # Check the tileset
+        if tileset.columns <= 0:
+            raise RuntimeError("Error in {}: invalid columns count".format(self.file_name))
+        if tileset.image.data is not None:
+            raise RuntimeError("Error in {}: embedded tileset image is not supported".format(self.file_name))
+
+        # All tiles of the layer must belong to the tileset
+        lids = layer.gids.astype(np.int64) - tileset.firstgid
+        empty = layer.gids == 0
+        if np.any(((lids < 0) | (lids >= tileset.tilecount)) & ~empty):
+            raise RuntimeError("Error in {}: invalid tile id".format(self.file_name))
+        lids[empty] = -1
+
+        return tileset, lids.reshape(self.height, self.width)
+
+    def decode_array_layer(self, layer):
+        """
+        Create an array of local tile ids from a layer
+        """
+        tileset, lids = self.decode_layer(layer)
+        return tileset, lids.astype(np.int32)
+
+    def decode_units_layer(self, state, layer):
+        """
+        Create a list of units from a layer
+        """
+        tileset, lids = self.decode_layer(layer)
+
+        units = []
+        ys, xs = np.nonzero(lids >= 0)
+        unit_lids = lids[ys, xs]
+        tiles_x = unit_lids % tileset.columns
+        tiles_y = unit_lids // tileset.columns
+        for x, y, tile_x, tile_y in zip(xs.tolist(), ys.tolist(), tiles_x.tolist(), tiles_y.tolist()):
+            unit = Unit(state, Vector2(x, y), Vector2(tile_x, tile_y))
+            units.append(unit)
+
+        return tileset, units
+
+    def read_tileset(self, tileset_root, directory):
+        firstgid = int(tileset_root.attrib["firstgid"])
+        source = tileset_root.attrib.get("source")
+        if source is not None:
+            source = os.path.join(directory, source)
+            tileset_root = ElementTree.parse(source).getroot()
+            directory = os.path.dirname(source)
+
+        image = None
+        image_root = tileset_root.find("image")
+        if image_root is not None:
+            image_source = image_root.attrib.get("source")
+            if image_source is not None:
+                image_source = os.path.join(directory, image_source)
+            data_root = image_root.find("data")
+            image_data = data_root.text.strip() if data_root is not None else None
+            image = TileMapImage(image_source, image_data)
+        if image is None:
+            raise RuntimeError("Error in {}: tileset without image".format(self.file_name))
+
+        return TileMapTileset(
+            firstgid,
+            int(tileset_root.attrib.get("tilewidth", 0)),
+            int(tileset_root.attrib.get("tileheight", 0)),
+            int(tileset_root.attrib.get("tilecount", 0)),
+            int(tileset_root.attrib.get("columns", 0)),
+            image
+        )
+
+    def read_layer(self, layer_root):
+        width = int(layer_root.attrib.get("width", self.width))
+        height = int(layer_root.attrib.get("height", self.height))
+        data_root = layer_root.find("data")
+        if data_root is None:
+            gids = np.zeros(0, dtype=np.uint32)
+        else:
+            gids = self.decode_data(data_root)
+        gids &= ~np.uint32(self.flip_flags_mask)
+        return TileMapLayer(layer_root.attrib.get("name", ""), width, height, gids)
+
+    def decode_data(self, data_root):
+        """
+        Decode a layer <data> element into a flat uint32 array of gids
+        """
+        encoding = data_root.attrib.get("encoding")
+        compression = data_root.attrib.get("compression")
+        if data_root.find("chunk") is not None:
+            raise RuntimeError("Error in {}: chunked layers are not supported".format(self.file_name))
+
+        if encoding is None:
+            gids = [int(tile.attrib.get("gid", 0)) for tile in data_root.iter("tile")]
+            return np.array(gids, dtype=np.uint32)
+
+        text = data_root.text or ""
+        if encoding == "csv":
+            if compression is not None:
+                raise RuntimeError("Error in {}: compressed csv layers are not supported".format(self.file_name))
+            try:
+                return np.fromstring(text, dtype=np.int64, sep=",").astype(np.uint32)
+            except ValueError:
+                raise RuntimeError("Error in {}: invalid csv layer data".format(self.file_name))
+
+        if encoding == "base64":
+            data = base64.b64decode(text.strip())
+            if compression == "zlib":
+                data = zlib.decompress(data)
+            elif compression == "gzip":
+                data = gzip.decompress(data)
+            elif compression is not None:
+                raise RuntimeError("Error in {}: unsupported compression {}".format(self.file_name, compression))
+            if len(data) % 4 != 0:
+                raise RuntimeError("Error in {}: invalid base64 layer data".format(self.file_name))
+            # Gids are little-endian unsigned 32 bits integers
+            return np.frombuffer(data, dtype="<u4").astype(np.uint32)
+
+        raise RuntimeError("Error in {}: unsupported encoding {}".format(self.file_name, encoding))
+
 
 ###############################################################################
 #                                Commands                                     #
@@ -137,7 +567,7 @@ class MoveCommand(Command):
             return
 
         # Don't allow wall positions
-        if self.state.walls[int(new_position.y)][int(new_position.x)] is not None:
+        if self.state.is_blocked(int(new_position.x), int(new_position.y)):
             return
 
         # Don't allow other unit positions
@@ -221,122 +651,32 @@ class LoadLevelCommand(Command):
         self.game_mode = game_mode
         self.file_name = file_name
 
-    def decode_layer(self, tile_map, layer):
-        """
-        Decode layer and check layer properties
-
-        Returns the corresponding tileset
-        """
-        if not isinstance(layer, tmx.Layer):
-            raise RuntimeError("Error in {}: invalid layer type".format(self.file_name))
-        if len(layer.tiles) != tile_map.width * tile_map.height:
-            raise RuntimeError("Error in {}: invalid tiles count".format(self.file_name))
-
-        # Guess which tileset is used by this layer
-        gid = None
-        for tile in layer.tiles:
-            if tile.gid != 0:
-                gid = tile.gid
-                break
-        if gid is None:
-            if len(tile_map.tilesets) == 0:
-                raise RuntimeError("Error in {}: no tilesets".format(self.file_name))
-            tileset = tile_map.tilesets[0]
-        else:
-            tileset = None
-            for t in tile_map.tilesets:
-                if t.firstgid <= gid < t.firstgid + t.tilecount:
-                    tileset = t
-                    break
-            if tileset is None:
-                raise RuntimeError("Error in {}: no corresponding tileset".format(self.file_name))
-
-        # Check the tileset
-        if tileset.columns <= 0:
-            raise RuntimeError("Error in {}: invalid columns count".format(self.file_name))
-        if tileset.image.data is not None:
-            raise RuntimeError("Error in {}: embedded tileset image is not supported".format(self.file_name))
-
-        return tileset
-
-    def decode_array_layer(self, tile_map, layer):
-        """
-        Create an array from a tileMap layer
-        """
-        tileset = self.decode_layer(tile_map, layer)
-
-        array = [None] * tile_map.height
-        for y in range(tile_map.height):
-            array[y] = [None] * tile_map.width
-            for x in range(tile_map.width):
-                tile = layer.tiles[x + y * tile_map.width]
-                if tile.gid == 0:
-                    continue
-                lid = tile.gid - tileset.firstgid
-                if lid < 0 or lid >= tileset.tilecount:
-                    raise RuntimeError("Error in {}: invalid tile id".format(self.file_name))
-                tile_x = lid % tileset.columns
-                tile_y = lid // tileset.columns
-                array[y][x] = Vector2(tile_x, tile_y)
-
-        return tileset, array
-
-    def decode_units_layer(self, state, tile_map, layer):
-        """
-        Create a list from a tileMap layer
-        """
-        tileset = self.decode_layer(tile_map, layer)
-
-        units = []
-        for y in range(tile_map.height):
-            for x in range(tile_map.width):
-                tile = layer.tiles[x + y * tile_map.width]
-                if tile.gid == 0:
-                    continue
-                lid = tile.gid - tileset.firstgid
-                if lid < 0 or lid >= tileset.tilecount:
-                    raise RuntimeError("Error in {}: invalid tile id".format(self.file_name))
-                tile_x = lid % tileset.columns
-                tile_y = lid // tileset.columns
-                unit = Unit(state, Vector2(x, y), Vector2(tile_x, tile_y))
-                units.append(unit)
-
-        return tileset, units
-
     def execute(self):
         # Load level
-        if not os.path.exists(self.file_name):
-            raise RuntimeError("No file {}".format(self.file_name))
-        tile_map = tmx.TileMap.load(self.file_name)
-
-        # Check main properties
-        if tile_map.orientation != "orthogonal":
-            raise RuntimeError("Error in {}: invalid orientation".format(self.file_name))
-        if len(tile_map.layers) != 5:
-            raise RuntimeError("Error in {}: 5 layers are expected".format(self.file_name))
+        tile_map = TileMap.load_level(self.file_name)
 
         # World size
         state = self.game_mode.game_state
         state.world_size = Vector2(tile_map.width, tile_map.height)
 
         # Ground layer
-        tileset, array = self.decode_array_layer(tile_map, tile_map.layers[0])
+        tileset, array = tile_map.decode_array_layer(tile_map.layers[0])
         cell_size = Vector2(tileset.tilewidth, tileset.tileheight)
-        state.ground[:] = array
+        state.ground.set_tiles(array, tileset.columns)
         image_file = tileset.image.source
         self.game_mode.layers[0].set_tileset(cell_size, image_file)
 
         # Walls Layer
-        tileset, array = self.decode_array_layer(tile_map, tile_map.layers[1])
+        tileset, array = tile_map.decode_array_layer(tile_map.layers[1])
         if tileset.tilewidth != cell_size.x or tileset.tileheight != cell_size.y:
             raise RuntimeError("Error in {}: tileset sizes must be the same in all layers".format(self.file_name))
-        state.walls[:] = array
+        state.set_walls(array, tileset.columns)
         image_file = tileset.image.source
         self.game_mode.layers[1].set_tileset(cell_size, image_file)
 
         # Units layer
-        tanks_tileset, tanks = self.decode_units_layer(state, tile_map, tile_map.layers[2])
-        towers_tileset, towers = self.decode_units_layer(state, tile_map, tile_map.layers[3])
+        tanks_tileset, tanks = tile_map.decode_units_layer(state, tile_map.layers[2])
+        towers_tileset, towers = tile_map.decode_units_layer(state, tile_map.layers[3])
         if tanks_tileset != towers_tileset:
             raise RuntimeError("Error in {}: tanks and towers tilesets must be the same")
         if tanks_tileset.tilewidth != cell_size.x or tanks_tileset.tileheight != cell_size.y:
@@ -350,7 +690,7 @@ class LoadLevelCommand(Command):
         self.game_mode.player_unit = tanks[0]
 
         # Explosion layer
-        tileset, array = self.decode_array_layer(tile_map, tile_map.layers[4])
+        tileset, array = tile_map.decode_array_layer(tile_map.layers[4])
         if tileset.tilewidth != cell_size.x or tileset.tileheight != cell_size.y:
             raise RuntimeError("Error in {}: tile sizes must be the same in a ll layers".format(self.file_name))
         state.bullets.clear()
@@ -363,6 +703,7 @@ class LoadLevelCommand(Command):
 
         # Resume game
         self.game_mode.game_over = False
+        self.game_mode.level_generation += 1
 
 
 ###############################################################################
@@ -370,6 +711,30 @@ class LoadLevelCommand(Command):
 ###############################################################################
 
 
+class RenderSnapshot:
+    """
+    Read-only copy of what is drawn in a frame, written at the end of a simulation tick
+    """
+
+    def __init__(self):
+        # Game modes only provide their resources (layers, fonts), which don't change until the next level loading
+        self.play_game_mode = None
+        self.overlay_game_mode = None
+        # Level of play_game_mode when the snapshot was written
+        self.level_generation = 0
+        # Overlay state
+        self.message = None
+        self.menu_item = 0
+        # (position, tile, orientation, weapon target or None if destroyed)
+        self.units = []
+        # (position, tile, orientation)
+        self.bullets = []
+        # (position, frame index)
+        self.explosions = []
+        # Cells visible by the player, or None if the whole map is visible
+        self.field_of_view = None
+
+
 class Layer(GameStateObserver):
     def __init__(self, cell_size, image_file):
         self.cell_size = cell_size
@@ -410,7 +775,19 @@ class Layer(GameStateObserver):
             # Render the rotated_tile
             surface.blit(rotated_tile, sprite_point)
 
-    def render(self, surface):
+    def write_snapshot(self, snapshot):
+        """
+        Copy the data drawn by this layer into snapshot
+        """
+        pass
+
+    def animate(self):
+        """
+        Advance the animations of this layer by one frame
+        """
+        pass
+
+    def render(self, surface, snapshot):
         raise NotImplementedError
 
 
@@ -426,15 +803,23 @@ class ArrayLayer(Layer):
         super().set_tileset(cell_size, image_file)
         self.surface = None
 
-    def render(self, surface):
+    def render(self, surface, snapshot):
         if self.surface is None:
             self.surface = pygame.Surface(surface.get_size(), flags=self.surface_flags)
-            for y in range(self.game_state.world_height):
-                for x in range(self.game_state.world_width):
-                    tile = self.array[y][x]
-                    if tile is not None:
-                        self.render_tile(self.surface, Vector2(x, y), tile)
-        surface.blit(self.surface, (0, 0))
+            # One row at a time, so that only the current row of cells is converted to Python ints
+            columns = self.array.columns
+            for y, row in enumerate(self.array.lids):
+                xs = np.flatnonzero(row >= 0)
+                for x, lid in zip(xs.tolist(), row[xs].tolist()):
+                    self.render_tile(self.surface, Vector2(x, y), Vector2(lid % columns, lid // columns))
+        if snapshot.field_of_view is None:
+            surface.blit(self.surface, (0, 0))
+        else:
+            # Only copy the visible cells of the prerendered layer
+            for x, y, length in snapshot.field_of_view.row_spans():
+                area = pygame.Rect(x * self.cell_width, y * self.cell_height,
+                                   length * self.cell_width, self.cell_height)
+                surface.blit(self.surface, area, area)
 
 
 class UnitsLayer(Layer):
@@ -443,13 +828,22 @@ class UnitsLayer(Layer):
         self.game_state = game_state
         self.units = units
 
-    def render(self, surface):
+    def write_snapshot(self, snapshot):
+        snapshot.units.clear()
         for unit in self.units:
-            self.render_tile(surface, unit.position, unit.tile, unit.orientation)
-            if unit.status == "alive":
-                size = unit.weapon_target - unit.position
+            weapon_target = Vector2(unit.weapon_target) if unit.status == "alive" else None
+            snapshot.units.append((Vector2(unit.position), Vector2(unit.tile), unit.orientation, weapon_target))
+
+    def render(self, surface, snapshot):
+        field_of_view = snapshot.field_of_view
+        for position, tile, orientation, weapon_target in snapshot.units:
+            if field_of_view is not None and not field_of_view.is_visible(int(position.x), int(position.y)):
+                continue
+            self.render_tile(surface, position, tile, orientation)
+            if weapon_target is not None:
+                size = weapon_target - position
                 angle = math.atan2(-size.x, -size.y) * 180 / math.pi
-                self.render_tile(surface, unit.position, Vector2(0, 6), angle)
+                self.render_tile(surface, position, Vector2(0, 6), angle)
 
 
 class BulletLayer(Layer):
@@ -458,10 +852,19 @@ class BulletLayer(Layer):
         self.game_state = game_state
         self.bullets = bullets
 
-    def render(self, surface):
+    def write_snapshot(self, snapshot):
+        snapshot.bullets.clear()
         for bullet in self.bullets:
             if bullet.status == "alive":
-                self.render_tile(surface, bullet.position, bullet.tile, bullet.orientation)
+                snapshot.bullets.append((Vector2(bullet.position), Vector2(bullet.tile), bullet.orientation))
+
+    def render(self, surface, snapshot):
+        field_of_view = snapshot.field_of_view
+        for position, tile, orientation in snapshot.bullets:
+            center = position + Vector2(0.5, 0.5)
+            if field_of_view is not None and not field_of_view.is_visible(int(center.x), int(center.y)):
+                continue
+            self.render_tile(surface, position, tile, orientation)
 
 
 class ExplosionLayer(Layer):
@@ -476,14 +879,24 @@ class ExplosionLayer(Layer):
     def unit_destroyed(self, unit):
         self.add(unit.position)
 
-    def render(self, surface):
+    def write_snapshot(self, snapshot):
+        snapshot.explosions.clear()
+        for explosion in self.explosions:
+            snapshot.explosions.append((Vector2(explosion['position']), math.floor(explosion['frame_index'])))
+
+    def animate(self):
         for explosion in self.explosions:
-            frame_index = math.floor(explosion['frame_index'])
-            self.render_tile(surface, explosion['position'], Vector2(frame_index, 4))
             explosion['frame_index'] += 0.5
         self.explosions = [explosion for explosion in self.explosions
                            if explosion['frame_index'] < self.max_frame_index]
 
+    def render(self, surface, snapshot):
+        field_of_view = snapshot.field_of_view
+        for position, frame_index in snapshot.explosions:
+            if field_of_view is not None and not field_of_view.is_visible(int(position.x), int(position.y)):
+                continue
+            self.render_tile(surface, position, Vector2(frame_index, 4))
+
 
 ###############################################################################
 #                                Game Modes                                   #
@@ -497,7 +910,10 @@ class GameMode:
     def update(self):
         raise NotImplementedError()
 
-    def render(self, window):
+    def write_snapshot(self, snapshot):
+        raise NotImplementedError()
+
+    def render(self, window, snapshot):
         raise NotImplementedError()
 
 
@@ -521,8 +937,11 @@ class MessageGameMode(GameMode):
     def update(self):
         pass
 
-    def render(self, window):
-        surface = self.font.render(self.message, True, (200, 0, 0))
+    def write_snapshot(self, snapshot):
+        snapshot.message = self.message
+
+    def render(self, window, snapshot):
+        surface = self.font.render(snapshot.message, True, (200, 0, 0))
         x = (window.get_width() - surface.get_width()) // 2
         y = (window.get_height() - surface.get_height()) // 2
         window.blit(surface, (x, y))
@@ -590,7 +1009,10 @@ class MenuGameMode(GameMode):
     def update(self):
         pass
 
-    def render(self, window):
+    def write_snapshot(self, snapshot):
+        snapshot.menu_item = self.current_menu_item
+
+    def render(self, window, snapshot):
         # Initial y
         y = 50
 
@@ -608,7 +1030,7 @@ class MenuGameMode(GameMode):
             window.blit(surface, (x, y))
 
             # Cursor
-            if index == self.current_menu_item:
+            if index == snapshot.menu_item:
                 cursor_x = x - self.menu_cursor.get_width() - 10
                 cursor_y = y + (surface.get_height() - self.menu_cursor.get_height()) // 2
                 window.blit(self.menu_cursor, (cursor_x, cursor_y))
@@ -617,8 +1039,11 @@ class MenuGameMode(GameMode):
 
 
 class PlayGameMode(GameMode):
-    def __init__(self, ui):
+    def __init__(self, ui, fog_of_war=False):
         self.ui = ui
+        self.fog_of_war = fog_of_war
+        # Incremented each time a level is loaded (new tilesets and window)
+        self.level_generation = 0
 
         # Game state
         self.game_state = GameState()
@@ -679,19 +1104,22 @@ class PlayGameMode(GameMode):
         if self.game_over:
             return
 
-        # Keyboard controls the moves of the player's unit
-        if move_vector.x != 0 or move_vector.y != 0:
-            self.commands.append(MoveCommand(self.game_state, self.player_unit, move_vector))
-
-        # Mouse controls the target of the player's unit
+        # Keyboard controls the moves of the player's unit, and the mouse its target
         mouse_position = pygame.mouse.get_pos()
         target_cell = Vector2()
         target_cell.x = mouse_position[0] / self.cell_width - 0.5
         target_cell.y = mouse_position[1] / self.cell_width - 0.5
-        self.commands.append(TargetCommand(self.game_state, self.player_unit, target_cell))
+        self.create_commands(move_vector, target_cell, mouse_clicked)
 
-        # Shoot if left mouse was clicked
-        if mouse_clicked:
+    def create_commands(self, move_vector, target_cell, shoot):
+        """
+        Create the commands of an epoch, given the player's actions
+        """
+        # Player's unit
+        if move_vector.x != 0 or move_vector.y != 0:
+            self.commands.append(MoveCommand(self.game_state, self.player_unit, move_vector))
+        self.commands.append(TargetCommand(self.game_state, self.player_unit, target_cell))
+        if shoot:
             self.commands.append(ShootCommand(self.game_state, self.player_unit))
 
         # Other units always target the player's unit and shoot if close enough
@@ -699,7 +1127,8 @@ class PlayGameMode(GameMode):
             if unit != self.player_unit:
                 self.commands.append(TargetCommand(self.game_state, unit, self.player_unit.position))
                 distance = unit.position.distance_to(self.player_unit.position)
-                if distance <= self.game_state.bullet_range:
+                if distance <= self.game_state.bullet_range \
+                        and self.game_state.visibility.can_see(unit.position, self.player_unit.position):
                     self.commands.append(ShootCommand(self.game_state, unit))
 
         # Bullets automatic movement
@@ -731,9 +1160,473 @@ class PlayGameMode(GameMode):
                 self.game_over = True
                 self.ui.show_message("Victory !")
 
-    def render(self, window):
+    def write_snapshot(self, snapshot):
+        snapshot.play_game_mode = self
+        snapshot.level_generation = self.level_generation
+        if self.fog_of_war:
+            snapshot.field_of_view = self.game_state.visibility.field_of_view(self.player_unit.position)
+        else:
+            snapshot.field_of_view = None
         for layer in self.layers:
-            layer.render(window)
+            layer.write_snapshot(snapshot)
+
+    def animate(self):
+        """
+        Advance the animations by one frame, also while paused or after a game over
+        """
+        for layer in self.layers:
+            layer.animate()
+
+    def render(self, window, snapshot):
+        if snapshot.field_of_view is not None:
+            window.fill((0, 0, 0))
+        for layer in self.layers:
+            layer.render(window, snapshot)
+
+
+###############################################################################
+#                                Profiling                                    #
+###############################################################################
+
+
+class MemoryProfiler:
+    """
+    Records allocations per frame phase (tracemalloc) and garbage collector pauses (gc.callbacks)
+
+    Retained (negative if freed) and peak sizes are measured every frame; the per-line hot spots come from
+    snapshot diffs taken once every snapshot_interval frames, since snapshots are slow. Tracing still slows
+    down every frame, so GC pause durations should be measured in a run without tracemalloc (see
+    DeferredGarbageCollector).
+    """
+
+    def __init__(self, enabled=False, top_count=10, pause_threshold=0.002, snapshot_interval=30):
+        self.enabled = enabled
+        self.top_count = top_count
+        self.pause_threshold = pause_threshold
+        self.snapshot_interval = snapshot_interval
+        self.frame_count = 0
+        self.sampled_frame_count = 0
+        self.current_phase = None
+        # Phase name -> {'retained': signed bytes, 'peak': bytes, 'lines': {traceback: bytes}}
+        self.phases = {}
+        # Generation -> list of (phase, duration, collected)
+        self.gc_pauses = {0: [], 1: [], 2: []}
+        self.gc_start_time = None
+        # Ignore the allocations made by the profiler itself, tracemalloc and the snapshot filtering
+        self.snapshot_filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, contextlib.__file__),
+            tracemalloc.Filter(False, fnmatch.__file__),
+            tracemalloc.Filter(False, os.path.join(os.path.dirname(re.__file__), "*")),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+        source_lines, first_line = inspect.getsourcelines(MemoryProfiler)
+        self.profiler_file = os.path.normcase(os.path.abspath(inspect.getsourcefile(MemoryProfiler)))
+        self.profiler_lines = range(first_line, first_line + len(source_lines))
+
+    def start(self):
+        if not self.enabled:
+            return
+        tracemalloc.start()
+        gc.callbacks.append(self.gc_callback)
+
+    def stop(self):
+        if not self.enabled:
+            return
+        if self.gc_callback in gc.callbacks:
+            gc.callbacks.remove(self.gc_callback)
+        tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Record the allocations made while running the enclosed code
+
+        Only the main thread phases are recorded, allocations from other threads are counted in them
+        """
+        if not self.enabled or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        self.current_phase = name
+        sampled = self.is_sampled_frame()
+        start_snapshot = None
+        if sampled:
+            start_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            end_size, peak_size = tracemalloc.get_traced_memory()
+            stats = self.phases.setdefault(name, {'retained': 0, 'peak': 0, 'lines': {}})
+            # Signed, so that memory freed in a phase offsets memory retained by another one
+            stats['retained'] += end_size - start_size
+            stats['peak'] = max(stats['peak'], peak_size - start_size)
+            if sampled:
+                self.record_lines(stats['lines'], start_snapshot, tracemalloc.take_snapshot())
+            self.current_phase = None
+
+    def is_sampled_frame(self):
+        return self.frame_count % self.snapshot_interval == 0
+
+    def is_profiler_frame(self, frame):
+        return os.path.normcase(os.path.abspath(frame.filename)) == self.profiler_file \
+            and frame.lineno in self.profiler_lines
+
+    def record_lines(self, lines, start_snapshot, end_snapshot):
+        start_snapshot = start_snapshot.filter_traces(self.snapshot_filters)
+        end_snapshot = end_snapshot.filter_traces(self.snapshot_filters)
+        for diff in end_snapshot.compare_to(start_snapshot, 'lineno'):
+            if diff.size_diff <= 0 or self.is_profiler_frame(diff.traceback[0]):
+                continue
+            lines[diff.traceback] = lines.get(diff.traceback, 0) + diff.size_diff
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        if self.is_sampled_frame():
+            self.sampled_frame_count += 1
+        self.frame_count += 1
+
+    def gc_callback(self, phase, info):
+        if phase == "start":
+            self.gc_start_time = time.perf_counter()
+        elif phase == "stop" and self.gc_start_time is not None:
+            duration = time.perf_counter() - self.gc_start_time
+            self.gc_start_time = None
+            generation = info['generation']
+            self.gc_pauses[generation].append((self.current_phase, duration, info['collected']))
+            if duration >= self.pause_threshold:
+                print("GC pause: generation {} took {:.2f} ms during {} (frame {}, {} collected)".format(
+                    generation, duration * 1000, self.current_phase or "idle", self.frame_count,
+                    info['collected']))
+
+    def report(self):
+        if not self.enabled:
+            return
+        frame_count = max(1, self.frame_count)
+        sampled_frame_count = max(1, self.sampled_frame_count)
+        print("Memory profile over {} frames ({} sampled for hot spots)".format(
+            self.frame_count, self.sampled_frame_count))
+        for name, stats in self.phases.items():
+            print("  {}: {:.1f} KiB retained/frame, {:.1f} KiB peak".format(
+                name, stats['retained'] / frame_count / 1024, stats['peak'] / 1024))
+            top_lines = sorted(stats['lines'].items(), key=lambda item: item[1], reverse=True)
+            for traceback, size in top_lines[:self.top_count]:
+                print("    {:.1f} KiB/sampled frame {}".format(size / sampled_frame_count / 1024, traceback))
+        for generation, pauses in self.gc_pauses.items():
+            if len(pauses) == 0:
+                continue
+            durations = [duration for _, duration, _ in pauses]
+            print("  GC generation {}: {} collections, {:.2f} ms total, {:.2f} ms max (slowed by tracing)".format(
+                generation, len(pauses), sum(durations) * 1000, max(durations) * 1000))
+
+
+class DeferredGarbageCollector:
+    """
+    Play-time GC policy: automatic collections are disabled, objects alive after a level load are frozen,
+    and collections are run at the end of frames that finished early
+    """
+
+    def __init__(self, enabled=False, frame_duration=1 / 60, idle_margin=0.004, max_pending_factor=10):
+        self.enabled = enabled
+        self.frame_duration = frame_duration
+        self.idle_margin = idle_margin
+        self.max_pending_factor = max_pending_factor
+        self.thresholds = gc.get_threshold()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.thresholds = gc.get_threshold()
+        gc.disable()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        gc.unfreeze()
+        gc.enable()
+
+    def level_loaded(self):
+        """
+        Move all the objects created by the level loading to the permanent generation
+        """
+        if not self.enabled:
+            return
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+    def idle(self, frame_time):
+        """
+        Run pending collections if the current frame left enough idle time
+        """
+        if not self.enabled:
+            return
+        count0, count1, count2 = gc.get_count()
+        threshold0, threshold1, threshold2 = self.thresholds
+        if count0 < threshold0:
+            return
+        idle_time = self.frame_duration - frame_time
+        if idle_time < self.idle_margin and count0 < self.max_pending_factor * threshold0:
+            return
+        if count2 >= threshold2:
+            gc.collect(2)
+        elif count1 >= threshold1:
+            gc.collect(1)
+        else:
+            gc.collect(0)
+
+
+###############################################################################
+#                                 Capture                                     #
+###############################################################################
+
+
+class FrameRecorder:
+    """
+    Copies the rendered window into a pool of reused pixel buffers, which a background thread encodes
+    as a PNG sequence or a raw RGB24 video file. Both encoders spend their time in zlib and file writes,
+    which release the GIL, so the game loop keeps running while a frame is encoded.
+
+    When all buffers are in use, frames are dropped so the game loop never waits, unless drop_frames is
+    False (headless rendering, where every frame must be recorded). Written frames are numbered
+    contiguously, the game frames which were dropped are listed in dropped_frames.txt.
+    """
+
+    png_signature = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, directory, file_format="png", buffer_count=8, drop_frames=True, png_compression=1):
+        if file_format not in ("png", "raw"):
+            raise RuntimeError("Unsupported capture format {}".format(file_format))
+        self.directory = directory
+        self.file_format = file_format
+        self.buffer_count = buffer_count
+        self.drop_frames = drop_frames
+        self.buffer_format = None
+        self.free_buffers = None
+        self.png_compression = png_compression
+        self.frames = queue.Queue()
+        # Game frames seen, and frames queued for writing
+        self.frame_index = 0
+        self.written_count = 0
+        self.dropped_frames = []
+        self.thread = None
+        # Raw video: a new file is started each time the window size changes
+        self.raw_file = None
+        self.raw_shape = None
+        self.raw_files = []
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.write_frames, name="FrameRecorder", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.frames.put(None)
+        self.thread.join()
+        self.thread = None
+        print("Captured {} frames ({} dropped) in {}".format(
+            self.written_count, len(self.dropped_frames), self.directory))
+        if len(self.dropped_frames) > 0:
+            with open(os.path.join(self.directory, "dropped_frames.txt"), "w") as file:
+                file.write("\n".join(str(frame_index) for frame_index in self.dropped_frames) + "\n")
+        if self.file_format == "png" and self.written_count > 0:
+            print("  ffmpeg -framerate 60 -i {} {}".format(
+                os.path.join(self.directory, "frame_%06d.png"), os.path.join(self.directory, "video.mp4")))
+        for file_name, (height, width, _) in self.raw_files:
+            print("  ffmpeg -f rawvideo -pix_fmt rgb24 -s {}x{} -r 60 -i {} {}.mp4".format(
+                width, height, file_name, os.path.splitext(file_name)[0]))
+
+    def capture(self, surface):
+        """
+        Copy the surface pixels (as stored by the surface) and queue them for encoding
+        """
+        width, height = surface.get_size()
+        bytesize = surface.get_bytesize()
+        if bytesize not in (3, 4):
+            raise RuntimeError("Unsupported capture pixel size {}".format(bytesize))
+        # Byte offsets of the red, green and blue components in a pixel
+        offsets = tuple(shift // 8 if sys.byteorder == "little" else bytesize - 1 - shift // 8
+                        for shift in surface.get_shifts()[:3])
+        pixel_format = (width, height, surface.get_pitch(), bytesize, offsets)
+        if pixel_format != self.buffer_format:
+            # Buffers of the previous format still in the queue are released to the old pool
+            self.buffer_format = pixel_format
+            self.free_buffers = queue.Queue()
+            for _ in range(self.buffer_count):
+                self.free_buffers.put(np.empty((height, surface.get_pitch()), dtype=np.uint8))
+
+        self.frame_index += 1
+        try:
+            buffer = self.free_buffers.get(block=not self.drop_frames)
+        except queue.Empty:
+            self.dropped_frames.append(self.frame_index - 1)
+            return
+        frame_index = self.written_count
+        self.written_count += 1
+
+        # Plain copy of the surface memory, pixels are converted to RGB by the writer thread
+        np.copyto(buffer, np.frombuffer(surface.get_buffer(), dtype=np.uint8).reshape(buffer.shape))
+        self.frames.put((frame_index, buffer, pixel_format, self.free_buffers))
+
+    def write_frames(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            frame_index, buffer, pixel_format, free_buffers = item
+            try:
+                pixels = self.convert_to_rgb(buffer, pixel_format)
+                if self.file_format == "png":
+                    self.write_png(frame_index, pixels)
+                else:
+                    self.write_raw(pixels)
+            except Exception as ex:
+                print(ex)
+            finally:
+                free_buffers.put(buffer)
+        if self.raw_file is not None:
+            self.raw_file.close()
+            self.raw_file = None
+
+    @staticmethod
+    def convert_to_rgb(buffer, pixel_format):
+        """
+        Returns a (height, width, 3) RGB array from a copy of the surface memory
+        """
+        width, height, _, bytesize, offsets = pixel_format
+        pixels = buffer[:, :width * bytesize].reshape(height, width, bytesize)
+        rgb = np.empty((height, width, 3), dtype=np.uint8)
+        for channel, offset in enumerate(offsets):
+            rgb[:, :, channel] = pixels[:, :, offset]
+        return rgb
+
+    def write_png(self, frame_index, buffer):
+        """
+        Write an 8 bits RGB PNG file (pygame.image.save would hold the GIL for the whole encoding)
+        """
+        height, width, _ = buffer.shape
+        # Each row starts with its filter type (0: none)
+        rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+        rows[:, 1:] = buffer.reshape(height, width * 3)
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        data = zlib.compress(rows, self.png_compression)
+        with open(os.path.join(self.directory, "frame_{:06d}.png".format(frame_index)), "wb") as file:
+            file.write(self.png_signature)
+            self.write_png_chunk(file, b"IHDR", header)
+            self.write_png_chunk(file, b"IDAT", data)
+            self.write_png_chunk(file, b"IEND", b"")
+
+    @staticmethod
+    def write_png_chunk(file, chunk_type, data):
+        file.write(struct.pack(">I", len(data)))
+        file.write(chunk_type)
+        file.write(data)
+        file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_raw(self, buffer):
+        if buffer.shape != self.raw_shape:
+            if self.raw_file is not None:
+                self.raw_file.close()
+            height, width, _ = buffer.shape
+            file_name = os.path.join(self.directory,
+                                     "video_{:03d}_{}x{}.rgb".format(len(self.raw_files), width, height))
+            self.raw_file = open(file_name, "wb")
+            self.raw_shape = buffer.shape
+            self.raw_files.append((file_name, buffer.shape))
+        self.raw_file.write(buffer.data)
+
+
+###############################################################################
+#                              Render Thread                                  #
+###############################################################################
+
+
+class RenderThread:
+    """
+    Pipelined rendering: the main thread writes each tick into one of two snapshots, while this thread
+    draws the last completed one.
+
+    If skip_frames is False, the main thread waits until each snapshot is picked up, so every tick is
+    rendered (headless capture).
+    """
+
+    def __init__(self, ui, skip_frames=True):
+        self.ui = ui
+        self.skip_frames = skip_frames
+        self.snapshots = [RenderSnapshot(), RenderSnapshot()]
+        self.condition = threading.Condition()
+        self.latest_index = None
+        self.rendering_index = None
+        self.pending = False
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="RenderThread", daemon=True)
+        self.thread.start()
+
+    def flush(self):
+        """
+        Wait until the last published snapshot is drawn
+        """
+        if self.thread is None:
+            return
+        with self.condition:
+            while (self.pending or self.rendering_index is not None) and self.thread.is_alive():
+                self.condition.wait(0.1)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        # Draw the last published snapshot first
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.thread = None
+
+    def back_snapshot(self):
+        """
+        Returns the index of the snapshot to write, and the snapshot; waits while it is being drawn
+        """
+        with self.condition:
+            index = 0 if self.latest_index is None else 1 - self.latest_index
+            while self.running and (self.rendering_index == index or (self.pending and not self.skip_frames)):
+                self.condition.wait()
+            return index, self.snapshots[index]
+
+    def publish(self, index):
+        with self.condition:
+            self.latest_index = index
+            self.pending = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                index = self.latest_index
+                self.rendering_index = index
+                self.pending = False
+                self.condition.notify_all()
+            try:
+                with self.ui.render_lock:
+                    self.ui.render_frame(self.snapshots[index])
+            except Exception as ex:
+                print(ex)
+            finally:
+                with self.condition:
+                    self.rendering_index = None
+                    self.condition.notify_all()
 
 
 ###############################################################################
@@ -742,8 +1635,11 @@ class PlayGameMode(GameMode):
 
 
 class UserInterface:
-    def __init__(self):
+    def __init__(self, profile_memory=False, defer_gc=False, headless=False, frame_recorder=None,
+                 render_thread=False, fog_of_war=False):
         # Window
+        if headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
         pygame.init()
         self.window = pygame.display.set_mode((1280, 720))
         pygame.display.set_caption("Practice")
@@ -757,14 +1653,35 @@ class UserInterface:
         # Loop properties
         self.clock = pygame.time.Clock()
         self.running = True
+        self.headless = headless
+        self.fog_of_war = fog_of_war
+
+        # Optional capture of the rendered frames
+        self.frame_recorder = frame_recorder
+
+        # Rendering, either at the end of each loop or in a separate thread
+        self.snapshot = RenderSnapshot()
+        self.render_lock = threading.Lock()
+        self.render_thread = None
+        if render_thread:
+            self.render_thread = RenderThread(self, skip_frames=not headless)
+
+        # Memory instrumentation and garbage collection policy
+        self.memory_profiler = MemoryProfiler(profile_memory)
+        self.garbage_collector = DeferredGarbageCollector(defer_gc)
 
     def load_level(self, file_name):
         if self.play_game_mode is None:
-            self.play_game_mode = PlayGameMode(self)
+            self.play_game_mode = PlayGameMode(self, self.fog_of_war)
         self.play_game_mode.commands.append(LoadLevelCommand(self.play_game_mode, file_name))
         try:
-            self.play_game_mode.update()
+            # Draw the pending snapshot of the previous level first, then the window can be recreated
+            if self.render_thread is not None:
+                self.render_thread.flush()
+            with self.render_lock:
+                self.play_game_mode.update()
             self.current_active_mode = 'Play'
+            self.garbage_collector.level_loaded()
         except Exception as ex:
             print(ex)
             self.play_game_mode = None
@@ -785,38 +1702,435 @@ class UserInterface:
     def quit_game(self):
         self.running = False
 
-    def run(self):
-        while self.running:
-            # Inputs and updates are exclusives
-            if self.current_active_mode == 'Overlay':
-                self.overlay_game_mode.process_input()
-                self.overlay_game_mode.update()
-            elif self.play_game_mode is not None:
-                self.play_game_mode.process_input()
-                try:
-                    self.play_game_mode.update()
-                except Exception as ex:
-                    print(ex)
-                    self.play_game_mode = None
-                    self.show_message("Error during the game update...")
-
-            # Render game (if any), and then the overlay (if active)
-            if self.play_game_mode is not None:
-                self.play_game_mode.render(self.window)
+    def write_snapshot(self, snapshot):
+        """
+        Copy the game (if any), and the overlay (if active) into snapshot
+        """
+        if self.play_game_mode is not None:
+            self.play_game_mode.write_snapshot(snapshot)
+        else:
+            snapshot.play_game_mode = None
+        if self.current_active_mode == 'Overlay':
+            snapshot.overlay_game_mode = self.overlay_game_mode
+            self.overlay_game_mode.write_snapshot(snapshot)
+        else:
+            snapshot.overlay_game_mode = None
+
+    def render_frame(self, snapshot):
+        # Safeguard: load_level() flushes the render thread, so no snapshot should predate the current level
+        # (it wouldn't match the new tilesets and window)
+        play_game_mode = snapshot.play_game_mode
+        if play_game_mode is not None and snapshot.level_generation != play_game_mode.level_generation:
+            return
+
+        # Render game (if any), and then the overlay (if active)
+        with self.memory_profiler.phase("render"):
+            if snapshot.play_game_mode is not None:
+                snapshot.play_game_mode.render(self.window, snapshot)
             else:
                 self.window.fill((0, 0, 0))
-            if self.current_active_mode == 'Overlay':
+            if snapshot.overlay_game_mode is not None:
                 dark_surface = pygame.Surface(self.window.get_size(), flags=pygame.SRCALPHA)
                 pygame.draw.rect(dark_surface, (0, 0, 0, 150), dark_surface.get_rect())
                 self.window.blit(dark_surface, (0, 0))
-                self.overlay_game_mode.render(self.window)
+                snapshot.overlay_game_mode.render(self.window, snapshot)
+
+        # Capture the rendered frame
+        if self.frame_recorder is not None:
+            with self.memory_profiler.phase("capture"):
+                self.frame_recorder.capture(self.window)
 
-            # Update display
+        # Update display
+        with self.memory_profiler.phase("display"):
             pygame.display.update()
-            self.clock.tick(60)
 
+    def run(self, max_frames=None):
+        self.memory_profiler.start()
+        self.garbage_collector.start()
+        if self.frame_recorder is not None:
+            self.frame_recorder.start()
+        if self.render_thread is not None:
+            self.render_thread.start()
+        frame_count = 0
+        try:
+            while self.running and (max_frames is None or frame_count < max_frames):
+                frame_start_time = time.perf_counter()
+
+                # Inputs and updates are exclusives
+                if self.current_active_mode == 'Overlay':
+                    with self.memory_profiler.phase("input"):
+                        self.overlay_game_mode.process_input()
+                    with self.memory_profiler.phase("update"):
+                        self.overlay_game_mode.update()
+                elif self.play_game_mode is not None:
+                    with self.memory_profiler.phase("input"):
+                        self.play_game_mode.process_input()
+                    try:
+                        with self.memory_profiler.phase("update"):
+                            self.play_game_mode.update()
+                    except Exception as ex:
+                        print(ex)
+                        self.play_game_mode = None
+                        self.show_message("Error during the game update...")
+
+                # Render, or hand the snapshot over to the render thread
+                with self.memory_profiler.phase("snapshot"):
+                    if self.render_thread is not None:
+                        index, snapshot = self.render_thread.back_snapshot()
+                        self.write_snapshot(snapshot)
+                        self.render_thread.publish(index)
+                    else:
+                        self.write_snapshot(self.snapshot)
+                if self.render_thread is None:
+                    self.render_frame(self.snapshot)
+
+                # Animations advance once per frame, after being copied into the snapshot
+                if self.play_game_mode is not None:
+                    self.play_game_mode.animate()
+
+                self.memory_profiler.end_frame()
+                self.garbage_collector.idle(time.perf_counter() - frame_start_time)
+                frame_count += 1
+
+                # Without a window, frames are rendered as fast as possible
+                if self.headless:
+                    self.clock.tick()
+                else:
+                    self.clock.tick(60)
+        finally:
+            if self.render_thread is not None:
+                self.render_thread.stop()
+            if self.frame_recorder is not None:
+                self.frame_recorder.stop()
+            self.garbage_collector.stop()
+            self.memory_profiler.stop()
+            self.memory_profiler.report()
+
+
+###############################################################################
+#                          Training Environments                              #
+###############################################################################
+
+
+class TrainingLevel:
+    """
+    Level data shared by all the training environments: walls, initial units, and the cells each unit
+    can see (units other than the player never move)
+    """
+
+    def __init__(self, file_name):
+        tile_map = TileMap.load_level(file_name)
+
+        # Game rules and walls
+        self.state = GameState()
+        self.state.world_size = Vector2(tile_map.width, tile_map.height)
+        tileset, array = tile_map.decode_array_layer(tile_map.layers[1])
+        self.state.set_walls(array, tileset.columns)
+        self.walls = array >= 0
+
+        # Units: the first tank is the player's one
+        _, tanks = tile_map.decode_units_layer(self.state, tile_map.layers[2])
+        _, towers = tile_map.decode_units_layer(self.state, tile_map.layers[3])
+        if len(tanks) == 0:
+            raise RuntimeError("Error in {}: no player tank".format(file_name))
+        units = tanks + towers
+        self.unit_positions = np.array([[int(unit.position.x), int(unit.position.y)] for unit in units],
+                                       dtype=np.int64)
+        self.is_enemy = np.ones(len(units), dtype=bool)
+        self.is_enemy[0] = False
+
+        # Cells visible from each unit, in a (2 * view_radius + 1) square window centered on the unit, whose
+        # top-left cell is visible_origins[unit]
+        radius = self.state.view_radius
+        self.visible = np.zeros((len(units), 2 * radius + 1, 2 * radius + 1), dtype=bool)
+        self.visible_origins = self.unit_positions - radius
+        for index, unit in enumerate(units):
+            fov = self.state.visibility.field_of_view(unit.position)
+            mask = np.array(fov.mask, dtype=bool)
+            left, top = fov.left - self.visible_origins[index, 0], fov.top - self.visible_origins[index, 1]
+            self.visible[index, top:top + mask.shape[0], left:left + mask.shape[1]] = mask
+
+    @property
+    def width(self):
+        return self.state.world_width
 
-user_interface = UserInterface()
-user_interface.run()
+    @property
+    def height(self):
+        return self.state.world_height
 
-pygame.quit()
+    @property
+    def unit_count(self):
+        return len(self.unit_positions)
+
+
+class VectorEnvironment:
+    """
+    Steps env_count copies of a level in lockstep, with the rules of PlayGameMode, and without window
+    or textures. Actions, observations, rewards and done flags are NumPy arrays batched on the first axis.
+
+    Observations are (env_count, 4, height, width) uint8 grids: walls, player, live enemies and bullets.
+    Episodes are terminated by the player's death or victory, and truncated when max_epochs is reached.
+    Terminated or truncated environments are reset at the end of step(), the last observations of these
+    environments (in increasing index order) are in infos['final_observations'].
+    """
+
+    observation_channels = 4
+
+    def __init__(self, file_name, env_count, max_epochs=None, kill_reward=1.0, death_reward=-1.0):
+        self.level = TrainingLevel(file_name)
+        self.env_count = env_count
+        self.max_epochs = max_epochs
+        self.kill_reward = kill_reward
+        self.death_reward = death_reward
+
+        # Rules
+        state = self.level.state
+        self.bullet_speed = state.bullet_speed
+        self.bullet_range = state.bullet_range
+        self.bullet_delay = state.bullet_delay
+        # Bullets slots per unit: a bullet lives at most bullet_range / bullet_speed epochs
+        self.bullet_slots = int(math.ceil(self.bullet_range / self.bullet_speed / self.bullet_delay)) + 1
+
+        # Environments state
+        unit_count = self.level.unit_count
+        shape = (env_count, unit_count)
+        bullet_shape = (env_count, unit_count, self.bullet_slots)
+        self.epoch = np.zeros(env_count, dtype=np.int64)
+        self.unit_positions = np.zeros(shape + (2,), dtype=np.int64)
+        self.alive = np.zeros(shape, dtype=bool)
+        self.last_bullet_epoch = np.zeros(shape, dtype=np.int64)
+        self.shot_count = np.zeros(shape, dtype=np.int64)
+        self.unit_grid = np.zeros((env_count, self.level.height, self.level.width), dtype=np.int32)
+        self.bullet_alive = np.zeros(bullet_shape, dtype=bool)
+        self.bullet_positions = np.zeros(bullet_shape + (2,), dtype=np.float64)
+        self.bullet_starts = np.zeros(bullet_shape + (2,), dtype=np.float64)
+        self.bullet_ends = np.zeros(bullet_shape + (2,), dtype=np.float64)
+        self.bullet_directions = np.zeros(bullet_shape + (2,), dtype=np.float64)
+
+        # Unit cells in a level without any unit destroyed or moved
+        self.initial_unit_grid = np.full((self.level.height, self.level.width), -1, dtype=np.int32)
+        positions = self.level.unit_positions
+        self.initial_unit_grid[positions[:, 1], positions[:, 0]] = np.arange(unit_count)
+
+        # Observation of one environment with only the walls, and flat offsets in an observation
+        cell_count = self.level.height * self.level.width
+        self.observation_size = self.observation_channels * cell_count
+        self.observation_template = np.zeros((self.observation_channels, self.level.height, self.level.width),
+                                             dtype=np.uint8)
+        self.observation_template[0] = self.level.walls
+        self.enemy_offsets = 2 * cell_count + positions[:, 1] * self.level.width + positions[:, 0]
+
+        self.reset()
+
+    def reset(self):
+        self.reset_environments(np.ones(self.env_count, dtype=bool))
+        return self.observe()
+
+    def reset_environments(self, mask):
+        self.epoch[mask] = 0
+        self.unit_positions[mask] = self.level.unit_positions
+        self.alive[mask] = True
+        self.last_bullet_epoch[mask] = -100
+        self.shot_count[mask] = 0
+        self.unit_grid[mask] = self.initial_unit_grid
+        self.bullet_alive[mask] = False
+
+    def observe(self, envs=None):
+        """
+        Returns the observations of all the environments, or of the envs indices
+        """
+        level = self.level
+        if envs is None:
+            envs = slice(None)
+        alive = self.alive[envs].copy()
+        unit_positions = self.unit_positions[envs]
+        observations = np.empty((len(alive), self.observation_channels, level.height, level.width),
+                                dtype=np.uint8)
+        observations[:] = self.observation_template
+        flat_observations = observations.reshape(-1)
+        bases = np.arange(len(alive)) * self.observation_size
+
+        # Player's unit
+        players = np.flatnonzero(alive[:, 0])
+        positions = unit_positions[players, 0]
+        flat_observations[bases[players] + level.height * level.width
+                          + positions[:, 1] * level.width + positions[:, 0]] = 1
+
+        # Live enemies never move
+        alive[:, 0] = False
+        rows, units = np.nonzero(alive)
+        flat_observations[bases[rows] + self.enemy_offsets[units]] = 1
+
+        # Bullets, in the cell of their center
+        per_env = level.unit_count * self.bullet_slots
+        bullets = np.flatnonzero(self.bullet_alive[envs])
+        cells = np.floor(self.bullet_positions[envs].reshape(-1, 2)[bullets] + 0.5).astype(np.int64)
+        inside = (cells[:, 0] < level.width) & (cells[:, 1] < level.height)
+        flat_observations[bases[bullets[inside] // per_env] + 3 * level.height * level.width
+                          + cells[inside, 1] * level.width + cells[inside, 0]] = 1
+
+        return observations
+
+    def step(self, move, target, shoot):
+        """
+        move: (env_count, 2) ints in {-1, 0, 1}
+        target: (env_count, 2) cell coordinates of the player's weapon target
+        shoot: (env_count,) bools
+
+        Returns observations, rewards, terminated, truncated and infos
+        """
+        level = self.level
+        envs = np.arange(self.env_count)
+        move = np.clip(np.asarray(move, dtype=np.int64).reshape(self.env_count, 2), -1, 1)
+        target = np.asarray(target, dtype=np.float64).reshape(self.env_count, 2)
+        shoot = np.asarray(shoot, dtype=bool).reshape(self.env_count)
+
+        # Other units target the player's unit and shoot if close enough and visible (as in process_input)
+        player_positions = self.unit_positions[:, 0].copy()
+        squared_distances = ((self.unit_positions - player_positions[:, None, :]) ** 2).sum(axis=2)
+        # Player's cell in the visibility window of each unit
+        window = player_positions[:, None, :] - level.visible_origins[None, :, :]
+        window_size = level.visible.shape[1]
+        in_window = ((window >= 0) & (window < window_size)).all(axis=2)
+        window = np.clip(window, 0, window_size - 1)
+        sees_player = in_window \
+            & level.visible[np.arange(level.unit_count)[None, :], window[:, :, 1], window[:, :, 0]]
+        enemies_shoot = level.is_enemy[None, :] & (squared_distances <= self.bullet_range ** 2) & sees_player
+
+        # Player's move
+        new_positions = player_positions + move
+        inside = (new_positions[:, 0] >= 0) & (new_positions[:, 0] < level.width) \
+            & (new_positions[:, 1] >= 0) & (new_positions[:, 1] < level.height)
+        new_x = np.clip(new_positions[:, 0], 0, level.width - 1)
+        new_y = np.clip(new_positions[:, 1], 0, level.height - 1)
+        free = ~level.walls[new_y, new_x] & (self.unit_grid[envs, new_y, new_x] < 0)
+        moves = self.alive[:, 0] & move.any(axis=1) & inside & free
+        self.unit_grid[envs[moves], player_positions[moves, 1], player_positions[moves, 0]] = -1
+        self.unit_grid[envs[moves], new_y[moves], new_x[moves]] = 0
+        self.unit_positions[moves, 0] = new_positions[moves]
+
+        # Shots (bullets created in this epoch only move from the next one)
+        moving_bullets = np.flatnonzero(self.bullet_alive)
+        shooters = enemies_shoot
+        shooters[:, 0] = shoot
+        shooters &= self.alive & (self.epoch[:, None] - self.last_bullet_epoch >= self.bullet_delay)
+        shots = np.flatnonzero(shooters)
+        shot_envs = shots // level.unit_count
+        starts = self.unit_positions.reshape(-1, 2)[shots].astype(np.float64)
+        ends = np.where((shots % level.unit_count == 0)[:, None], target[shot_envs], player_positions[shot_envs])
+        directions = ends - starts
+        lengths = np.sqrt((directions ** 2).sum(axis=1))
+        valid = lengths > 0
+        shots = shots[valid]
+        shot_envs = shot_envs[valid]
+        starts = starts[valid]
+        ends = ends[valid]
+        directions = directions[valid] / lengths[valid, None]
+        slots = shots * self.bullet_slots + self.shot_count.reshape(-1)[shots] % self.bullet_slots
+        self.last_bullet_epoch.reshape(-1)[shots] = self.epoch[shot_envs]
+        self.shot_count.reshape(-1)[shots] += 1
+        bullet_alive = self.bullet_alive.reshape(-1)
+        bullet_positions = self.bullet_positions.reshape(-1, 2)
+        bullet_starts = self.bullet_starts.reshape(-1, 2)
+        bullet_ends = self.bullet_ends.reshape(-1, 2)
+        bullet_directions = self.bullet_directions.reshape(-1, 2)
+        bullet_alive[slots] = True
+        bullet_positions[slots] = starts
+        bullet_starts[slots] = starts
+        bullet_ends[slots] = ends
+        bullet_directions[slots] = directions
+
+        # Bullets moves (as in MoveBulletCommand)
+        alive_before = self.alive.copy()
+        bullets = moving_bullets
+        bullet_envs = bullets // (level.unit_count * self.bullet_slots)
+        bullet_units = (bullets // self.bullet_slots) % level.unit_count
+        direction = bullet_directions[bullets]
+        end = bullet_ends[bullets]
+        new_position = bullet_positions[bullets] + self.bullet_speed * direction
+        inside = (new_position[:, 0] >= 0) & (new_position[:, 0] < level.width) \
+            & (new_position[:, 1] >= 0) & (new_position[:, 1] < level.height)
+        reached = (((direction[:, 0] >= 0) & (new_position[:, 0] >= end[:, 0]))
+                   | ((direction[:, 0] < 0) & (new_position[:, 0] <= end[:, 0]))) \
+            & (((direction[:, 1] >= 0) & (new_position[:, 1] >= end[:, 1]))
+               | ((direction[:, 1] < 0) & (new_position[:, 1] <= end[:, 1])))
+        out_of_range = np.sqrt(((new_position - bullet_starts[bullets]) ** 2).sum(axis=1)) >= self.bullet_range
+        destroyed = ~inside | reached | out_of_range
+
+        # Hits: a unit is destroyed by the first bullet reaching it, the other ones pass through
+        cells = np.floor(new_position + 0.5).astype(np.int64)
+        cell_x = np.clip(cells[:, 0], 0, level.width - 1)
+        cell_y = np.clip(cells[:, 1], 0, level.height - 1)
+        hit_units = np.where(~destroyed & (cells[:, 0] < level.width) & (cells[:, 1] < level.height),
+                             self.unit_grid[bullet_envs, cell_y, cell_x], -1)
+        hits = (hit_units >= 0) & (hit_units != bullet_units)
+        hits[hits] = self.alive[bullet_envs[hits], hit_units[hits]]
+        hit_indices = np.flatnonzero(hits)
+        _, first = np.unique(bullet_envs[hit_indices] * level.unit_count + hit_units[hit_indices],
+                             return_index=True)
+        hits[:] = False
+        hits[hit_indices[first]] = True
+        self.alive[bullet_envs[hits], hit_units[hits]] = False
+
+        moved = ~(destroyed | hits)
+        bullet_alive[bullets] = moved
+        bullet_positions[bullets[moved]] = new_position[moved]
+        self.epoch += 1
+
+        # Rewards and game over
+        killed = alive_before & ~self.alive
+        rewards = self.kill_reward * (killed & level.is_enemy[None, :]).sum(axis=1) \
+            + self.death_reward * killed[:, 0]
+        victories = self.alive[:, 0] & ~(self.alive & level.is_enemy[None, :]).any(axis=1)
+        terminated = ~self.alive[:, 0] | victories
+        # Time limit: value estimates of these environments should be bootstrapped, not considered final
+        if self.max_epochs is not None:
+            truncated = ~terminated & (self.epoch >= self.max_epochs)
+        else:
+            truncated = np.zeros(self.env_count, dtype=bool)
+        dones = terminated | truncated
+        infos = {'victory': victories, 'epoch': self.epoch.copy()}
+
+        # Auto reset
+        if dones.any():
+            done_envs = np.flatnonzero(dones)
+            infos['final_observations'] = self.observe(done_envs)
+            self.reset_environments(dones)
+
+        return self.observe(), rewards, terminated, truncated, infos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tank game")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="record allocations per frame phase and garbage collector pauses")
+    parser.add_argument("--defer-gc", action="store_true",
+                        help="freeze level objects and run garbage collections during idle frame time")
+    parser.add_argument("--capture", metavar="DIRECTORY",
+                        help="record the rendered frames in this directory")
+    parser.add_argument("--capture-format", choices=["png", "raw"], default="png",
+                        help="PNG sequence, or raw RGB24 video file")
+    parser.add_argument("--headless", action="store_true",
+                        help="render without a window and without frame rate limit")
+    parser.add_argument("--render-thread", action="store_true",
+                        help="render the previous tick in a separate thread while the next one is simulated")
+    parser.add_argument("--fog-of-war", action="store_true",
+                        help="only show the cells in the player's field of view")
+    parser.add_argument("--level", metavar="FILE",
+                        help="start directly with this level")
+    parser.add_argument("--max-frames", type=int,
+                        help="quit after this number of frames")
+    args = parser.parse_args()
+
+    frame_recorder = None
+    if args.capture is not None:
+        # Headless rendering runs faster than real time: wait for the writer rather than drop frames
+        frame_recorder = FrameRecorder(args.capture, args.capture_format, drop_frames=not args.headless)
+
+    user_interface = UserInterface(args.profile_memory, args.defer_gc, args.headless, frame_recorder,
+                                   args.render_thread, args.fog_of_war)
+    if args.level is not None:
+        user_interface.load_level(args.level)
+    user_interface.run(args.max_frames)
+
+    pygame.quit()
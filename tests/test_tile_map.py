@@ -0,0 +1,77 @@
+import base64
+import gzip
+import os
+import xml.etree.ElementTree as ElementTree
+import zlib
+
+import numpy as np
+import pytest
+
+import main
+from conftest import ROOT
+
+LEVEL = os.path.join(ROOT, "assets", "level1.tmx")
+
+
+def write_level(tmp_path, encode):
+    """
+    Write level1 with the <data> element of each layer replaced by encode(data, gids)
+    """
+    tree = ElementTree.parse(LEVEL)
+    for data_root in tree.getroot().iter("data"):
+        gids = np.fromstring(data_root.text, dtype=np.int64, sep=",").astype(np.uint32)
+        data_root.attrib.clear()
+        data_root.text = None
+        encode(data_root, gids)
+    file_name = str(tmp_path / "level.tmx")
+    tree.write(file_name)
+    return file_name
+
+
+def encode_xml(data_root, gids):
+    for gid in gids.tolist():
+        ElementTree.SubElement(data_root, "tile", {"gid": str(gid)} if gid != 0 else {})
+
+
+def base64_encoder(compress, compression):
+    def encode(data_root, gids):
+        data_root.set("encoding", "base64")
+        if compression is not None:
+            data_root.set("compression", compression)
+        data_root.text = base64.b64encode(compress(gids.astype("<u4").tobytes())).decode("ascii")
+    return encode
+
+
+@pytest.mark.parametrize("encode", [
+    encode_xml,
+    base64_encoder(lambda data: data, None),
+    base64_encoder(zlib.compress, "zlib"),
+    base64_encoder(gzip.compress, "gzip"),
+], ids=["xml", "base64", "base64-zlib", "base64-gzip"])
+def test_encodings_match_csv(tmp_path, encode):
+    expected = main.TileMap.load(LEVEL)
+    tile_map = main.TileMap.load(write_level(tmp_path, encode))
+    assert len(tile_map.layers) == len(expected.layers) == 5
+    for layer, expected_layer in zip(tile_map.layers, expected.layers):
+        assert layer.gids.dtype == np.uint32
+        np.testing.assert_array_equal(layer.gids, expected_layer.gids)
+
+
+def test_flip_flags_are_cleared(tmp_path):
+    def encode(data_root, gids):
+        gids = gids.copy()
+        gids[0] |= 0x80000000
+        base64_encoder(lambda data: data, None)(data_root, gids)
+    tile_map = main.TileMap.load(write_level(tmp_path, encode))
+    expected = main.TileMap.load(LEVEL)
+    np.testing.assert_array_equal(tile_map.layers[0].gids, expected.layers[0].gids)
+
+
+@pytest.mark.parametrize("encode", [
+    base64_encoder(lambda data: data, "lzma"),
+    base64_encoder(lambda data: data[:-1], None),
+    lambda data_root, gids: (data_root.set("encoding", "csv"), setattr(data_root, "text", "1,x,3")),
+], ids=["unknown-compression", "truncated-base64", "invalid-csv"])
+def test_invalid_data_is_rejected(tmp_path, encode):
+    with pytest.raises(RuntimeError):
+        main.TileMap.load(write_level(tmp_path, encode))
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from pygame.math import Vector2
+
+import main
+from conftest import ROOT
+
+
+@pytest.fixture
+def ui(monkeypatch):
+    # Levels and textures are loaded with paths relative to the repository root
+    monkeypatch.chdir(ROOT)
+    return main.UserInterface(headless=True)
+
+
+def game_observation(game_mode):
+    """
+    Observation of the command-based game, with the channels of VectorEnvironment
+    """
+    state = game_mode.game_state
+    observation = np.zeros((4, state.world_height, state.world_width), dtype=np.uint8)
+    observation[0] = state.walls.lids >= 0
+    for unit in state.units:
+        if unit.status == "alive":
+            channel = 1 if unit is game_mode.player_unit else 2
+            observation[channel, int(unit.position.y), int(unit.position.x)] = 1
+    for bullet in state.bullets:
+        cell = bullet.position + Vector2(0.5, 0.5)
+        if state.is_inside(cell):
+            observation[3, int(cell.y), int(cell.x)] = 1
+    return observation
+
+
+@pytest.mark.parametrize("level", ["assets/level1.tmx", "assets/level2.tmx"])
+def test_vector_environment_matches_play_game_mode(ui, level):
+    """
+    Same random actions in PlayGameMode and VectorEnvironment give the same observations and game overs
+    """
+    rng = np.random.default_rng(0)
+    env = main.VectorEnvironment(level, 1)
+    observations = env.reset()
+    ui.load_level(level)
+    game_mode = ui.play_game_mode
+    np.testing.assert_array_equal(observations[0], game_observation(game_mode))
+
+    episodes = 0
+    for step in range(3000):
+        # Aim at an enemy most of the time, so that episodes end with victories and game overs
+        move = rng.integers(-1, 2, size=2)
+        if rng.random() < 0.8:
+            enemy = game_mode.game_state.units[rng.integers(1, len(game_mode.game_state.units))]
+            target = np.array([enemy.position.x, enemy.position.y]) + rng.uniform(-1, 1, size=2)
+        else:
+            target = rng.uniform(-1, max(env.level.width, env.level.height), size=2)
+        shoot = bool(rng.random() < 0.5)
+
+        game_mode.create_commands(Vector2(int(move[0]), int(move[1])), Vector2(target[0], target[1]), shoot)
+        game_mode.update()
+        observations, rewards, terminated, truncated, infos = env.step(move[None, :], target[None, :], [shoot])
+        assert not truncated[0]
+
+        final_observation = infos['final_observations'][0] if terminated[0] else observations[0]
+        np.testing.assert_array_equal(final_observation, game_observation(game_mode),
+                                      err_msg="{} step {}".format(level, step))
+        assert terminated[0] == game_mode.game_over, "{} step {}".format(level, step)
+        if terminated[0]:
+            assert infos['victory'][0] == (game_mode.player_unit.status == "alive")
+            episodes += 1
+            ui.load_level(level)
+            game_mode = ui.play_game_mode
+            np.testing.assert_array_equal(observations[0], game_observation(game_mode))
+
+    assert episodes > 0
+
+
+def test_vector_environment_truncates_at_max_epochs(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    env = main.VectorEnvironment("assets/level1.tmx", 2, max_epochs=5)
+    initial_observations = env.reset()
+    move = np.zeros((2, 2), dtype=np.int64)
+    move[0] = (0, -1)
+    target = np.zeros((2, 2))
+    for epoch in range(1, 6):
+        observations, rewards, terminated, truncated, infos = env.step(move, target, [False, False])
+        assert not terminated.any()
+        np.testing.assert_array_equal(truncated, epoch == 5)
+
+    # Truncated environments are reset, and their last observations are kept
+    np.testing.assert_array_equal(observations, initial_observations)
+    assert not np.array_equal(infos['final_observations'][0], initial_observations[0])
+    np.testing.assert_array_equal(env.epoch, 0)
@@ -0,0 +1,71 @@
+import numpy as np
+from pygame.math import Vector2
+
+import main
+
+
+def make_state(walls):
+    """
+    Game state with walls given as a (height, width) array of bools
+    """
+    height, width = walls.shape
+    state = main.GameState()
+    state.world_size = Vector2(width, height)
+    state.walls = main.TileGrid(width, height, 16)
+    state.set_walls(np.where(walls, 0, -1), 16)
+    return state
+
+
+def test_wall_row_blocks_can_see():
+    walls = np.zeros((10, 16), dtype=bool)
+    state = make_state(walls)
+    assert state.visibility.can_see(Vector2(8, 8), Vector2(8, 2))
+
+    walls[5, :] = True
+    state = make_state(walls)
+    assert not state.visibility.can_see(Vector2(8, 8), Vector2(8, 2))
+    assert not state.visibility.can_see(Vector2(8, 2), Vector2(8, 8))
+    assert state.visibility.can_see(Vector2(8, 8), Vector2(10, 6))
+
+
+def test_walls_are_visible():
+    walls = np.zeros((10, 16), dtype=bool)
+    walls[5, 6:11] = True
+    walls[4, 8] = True
+    state = make_state(walls)
+    for x in range(6, 11):
+        assert state.visibility.can_see(Vector2(8, 8), Vector2(x, 5))
+    # Behind the front wall
+    assert not state.visibility.can_see(Vector2(8, 8), Vector2(8, 4))
+
+
+def test_view_radius():
+    state = make_state(np.zeros((20, 20), dtype=bool))
+    radius = state.view_radius
+    assert state.visibility.can_see(Vector2(0, 0), Vector2(radius, 0))
+    assert not state.visibility.can_see(Vector2(0, 0), Vector2(radius + 1, 0))
+    assert not state.visibility.can_see(Vector2(0, 0), Vector2(radius, 1))
+
+
+def test_set_walls_clears_cache():
+    walls = np.zeros((10, 16), dtype=bool)
+    walls[5, :] = True
+    state = make_state(walls)
+    assert not state.visibility.can_see(Vector2(8, 8), Vector2(8, 2))
+    assert len(state.visibility.cache) > 0
+
+    state.set_walls(np.full((10, 16), -1), 16)
+    assert len(state.visibility.cache) == 0
+    assert state.visibility.can_see(Vector2(8, 8), Vector2(8, 2))
+
+
+def test_can_see_is_symmetric():
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        walls = rng.random((15, 20)) < 0.25
+        state = make_state(walls)
+        ys, xs = np.nonzero(~walls)
+        cells = [Vector2(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+        for a in cells:
+            for b in cells:
+                assert state.visibility.can_see(a, b) == state.visibility.can_see(b, a), (a, b)